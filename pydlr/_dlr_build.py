@@ -0,0 +1,103 @@
+"""CFFI build script for the out-of-line API mode interface to libdlr_c
+
+Compiles the extension module `pydlr._dlr_cffi` against the C interface
+header `dlr_c.h` and the shared library `libdlr_c.*`. The CMake build does
+this when configured with `-Dwith_python=ON`, in a source checkout with
+the library built into `lib/` run
+
+    python pydlr/_dlr_build.py
+
+The extension finds libdlr_c through the relative run path `../lib`, the
+layout of both the build tree and the installation.
+
+When the extension is not available pydlr.kernel_fortran falls back to
+loading the library at runtime (ABI mode) using the same declarations.
+
+Copyright 2021 Hugo U.R. Strand
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License."""
+
+
+import os
+import sys
+import shutil
+import tempfile
+
+from cffi import FFI
+
+
+# -- Declarations of the libdlr_c routines used by pydlr.kernel_fortran
+
+CDEF = """
+void c_ccfine_init(double *lambda, int *p, int *npt, int *npo, int *nt, int *no);
+void c_ccfine(double *lambda, int *p, int *npt, int *npo, double *t, double *om);
+void c_dlr_kfine(double *lambda, int *p, int *npt, int *npo, double *t, double *om, double *kmat, double *err);
+void c_dlr_rf(double *lambda, double *eps, int *nt, int *no, double *om, double *kmat, int *rank, double *dlrrf, int *oidx);
+void c_dlr_it(double *lambda, int *nt, int *no, double *t, double *kmat, int *rank, int *oidx, double* dlrit, int *tidx);
+void c_dlr_cf2it_init(int *rank, double *dlrrf, double *dlrit, double *cf2it);
+void c_dlr_it2cf_init(int *rank, double *dlrrf, double *dlrit, double *dlrit2cf, int *it2cfpiv);
+void c_dlr_mf(int *nmax, int *rank, double *dlrrf, int *xi, int *dlrmf);
+void c_dlr_cf2mf_init(int *rank, double *dlrrf,int *dlrmf, int *xi, double _Complex *cf2mf);
+void c_dlr_mf2cf_init(int *nmax, int *rank, double *dlrrf,int *dlrmf, int *xi, double _Complex *dlrmf2cf, int *mf2cfpiv);
+"""
+
+# -- Scalar arguments of the c_* calls, allocated as one struct per construction
+
+STRUCT = "struct dlr_scalars { double lamb, eps; int p, npt, npo, nt, no, rank, nmax, xi; };"
+
+
+def get_ffi():
+    """ FFI with the libdlr_c declarations, shared by the API and ABI modes """
+    ffi = FFI()
+    ffi.cdef(CDEF)
+    ffi.cdef(STRUCT)
+    return ffi
+
+
+# -- Run path of the extension relative to its own location
+_ORIGIN = '@loader_path' if sys.platform == 'darwin' else '$ORIGIN'
+
+
+def build(include_dir, library_dir, output_dir, verbose=False):
+    """ Compile the API mode extension and place it in `output_dir` """
+
+    ffibuilder = get_ffi()
+    ffibuilder.set_source(
+        'pydlr._dlr_cffi',
+        '#include "dlr_c.h"\n' + STRUCT,
+        include_dirs=[include_dir],
+        libraries=['dlr_c'],
+        library_dirs=[library_dir],
+        extra_link_args=[f'-Wl,-rpath,{_ORIGIN}/../lib'],
+        )
+
+    # -- Compile out of tree, only the extension module is kept
+    with tempfile.TemporaryDirectory() as tmpdir:
+        module = ffibuilder.compile(tmpdir=tmpdir, verbose=verbose)
+        shutil.copy2(module, output_dir)
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    pydlr_dir = os.path.dirname(os.path.abspath(__file__))
+    root = os.path.dirname(pydlr_dir)
+
+    parser = argparse.ArgumentParser(description='Build the pydlr._dlr_cffi extension.')
+    parser.add_argument('--include-dir', default=os.path.join(root, 'src', 'dlr_c'))
+    parser.add_argument('--library-dir', default=os.path.join(root, 'lib'))
+    parser.add_argument('--output-dir', default=pydlr_dir)
+    args = parser.parse_args()
+
+    build(args.include_dir, args.library_dir, args.output_dir, verbose=True)
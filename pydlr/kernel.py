@@ -15,12 +15,29 @@ or implied. See the License for the specific language governing
 permissions and limitations under the License."""
 
 
+import time
+import logging
+
 import numpy as np
 
+from scipy.special import expit
 from scipy.linalg import lu_solve, lu_factor
+from scipy.linalg import get_lapack_funcs
 from scipy.linalg.interpolative import interp_decomp
 
 
+log = logging.getLogger(__name__)
+
+
+def _debug(logger, verbose, msg, *args):
+    """ Print diagnostics when `verbose`, otherwise pass them on to `logger`
+
+    The logger level and handlers are left to the application, messages are
+    formatted lazily and never emitted twice. """
+    if verbose: print(msg % args)
+    else: logger.debug(msg, *args, stacklevel=2)
+
+
 def chebyshev_collocation_points_1st_kind(N):
     """
     Return the Chebyshev collocation points of the first kind.
@@ -115,7 +132,8 @@ def barycentric_chebyshev_interpolation(x, x_j, f_j, w_j):
         Chebyshev collocation points :math:`x_j` of the first kind
 
     f_j : ndarray
-        Values  :math:`f_j` of the polynomial at the collocation points, :math:`f_j = f(x_j)`
+        Values  :math:`f_j` of the polynomial at the collocation points, :math:`f_j = f(x_j)`,
+        additional trailing dimensions are interpolated element wise.
 
     w_j : ndarray
         Chebyshev barycentric interpolation weights :math:`w_j`
@@ -147,22 +165,30 @@ def barycentric_chebyshev_interpolation(x, x_j, f_j, w_j):
     """
     
     # -- Barycentric interpolation off the grid
-    with np.testing.suppress_warnings() as sup:
-        sup.filter(RuntimeWarning, "divide by zero encountered in true_divide")
-        sup.filter(RuntimeWarning, "invalid value encountered in true_divide")
-        
-        q_xj = w_j[:, None] / (x[None, :] - x_j[:, None])
-        f_x = np.sum(q_xj * f_j[:, None, ...], axis=0) / np.sum(q_xj, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dx_jx = x[None, :] - x_j[:, None]
+        q_jx = w_j[:, None] / dx_jx
+        norm_x = np.sum(q_jx, axis=0).reshape((len(x),) + (1,) * (f_j.ndim - 1))
+        f_x = np.tensordot(q_jx, f_j, axes=(0, 0)) / norm_x
 
     # -- Direct value lookup if x is on the grid x_j
-    idxs = np.argwhere(x[:, None] == x_j[None, :])
-    if len(idxs) > 0:
-        xidx, j = idxs.T
-        f_x[xidx] = f_j[j]
+    j, xidx = np.nonzero(dx_jx == 0.)
+    f_x[xidx] = f_j[j]
     
     return f_x
 
 
+def _barycentric_interpolation_matrix(x, x_j, w_j):
+    """
+    Return the barycentric interpolation matrix :math:`B_{ij}` with :math:`f(x_i) = \\sum_j B_{ij} f_j`.
+
+    No on grid check is performed, the points :math:`x` must be disjoint from :math:`x_j`.
+    """
+    q_ji = w_j[:, None] / (x[None, :] - x_j[:, None])
+    B_ij = (q_ji / np.sum(q_ji, axis=0)[None, :]).T
+    return B_ij
+
+
 def fermi_function(E, beta):
     """
     Evaluate the Fermi distribution function at energy :math:`E` and inverse temperature :math:`\beta`.
@@ -171,7 +197,7 @@ def fermi_function(E, beta):
 
     .. math:: f_\\beta(E) = \\frac{1}{1 + e^{\\beta E}}
 
-    the evaluation is stabilized using separate formulas for :math:`E \lessgtr 0`.
+    the evaluation is stabilized using the logistic function :math:`f_\\beta(E) = \\text{expit}(-\\beta E)`.
 
     Parameters
     ----------
@@ -190,16 +216,11 @@ def fermi_function(E, beta):
     
     """
     
-    f = np.zeros_like(E)
-    p, m = np.argwhere(E > 0), np.argwhere(E <= 0)
-
-    f[p] = np.exp(-beta*E[p]) / (1. + np.exp(-beta*E[p]))
-    f[m] = 1. / (np.exp(beta*E[m]) + 1.)
-
+    f = expit(-beta*E)
     return f
 
 
-def kernel(tau, omega):
+def kernel(tau, omega, out=None):
     """
     Evaluate the imaginary time and real frequency analytical continuation kernel :math:`K(\\tau, \\omega)`.
 
@@ -209,7 +230,11 @@ def kernel(tau, omega):
 
     in normalized imaginary time :math:`\\tau \\in [0, 1]` and frequency :math:`\omega`.
 
-    The evaluation is stabilized using separate formulas for :math:`E \lessgtr 0`.
+    The evaluation is stabilized by rewriting the kernel in terms of :math:`|\\omega|` as
+
+    .. math:: K(\\tau, \\omega) = \\frac{e^{-s |\\omega|}}{1 + e^{-|\\omega|}}
+
+    with :math:`s = \\tau` for :math:`\\omega > 0` and :math:`s = 1 - \\tau` otherwise.
 
     Parameters
     ----------
@@ -220,6 +245,9 @@ def kernel(tau, omega):
     omega : ndarray
         Points in real frequency :math:`\\omega_k`
 
+    out : ndarray, optional
+        Array of shape `(len(tau), len(omega))` to store the result in. Default `None`.
+
     Returns
     -------
 
@@ -229,16 +257,17 @@ def kernel(tau, omega):
 
     """
 
-    kernel = np.empty((len(tau), len(omega)))
-
-    p, = np.where(omega > 0.)
-    m, = np.where(omega <= 0.)
-    w_p, w_m = omega[p].T, omega[m].T
+    tau, omega = tau[:, None], omega[None, :]
+    w_abs = np.abs(omega)
 
-    tau = tau[:, None]
+    # -- Single (nt, no) buffer, all later operations are done in place
 
-    kernel[:, p] = np.exp(-tau*w_p) / (1 + np.exp(-w_p))
-    kernel[:, m] = np.exp((1. - tau)*w_m) / (1 + np.exp(w_m))
+    kernel = np.empty((tau.shape[0], omega.shape[1])) if out is None else out
+    np.copyto(kernel, tau)
+    np.copyto(kernel, 1. - tau, where=(omega <= 0.))
+    kernel *= -w_abs
+    np.exp(kernel, out=kernel)
+    kernel /= 1 + np.exp(-w_abs)
 
     return kernel
 
@@ -285,6 +314,13 @@ def gridparams(lamb, order=24):
     return order, npt, npo, nt, no
 
 
+def _composite_panel_points(break_pt, x_i):
+    """Map the points :math:`x_i \\in [-1, 1]` onto every panel :math:`[a, b]` given by the panel break points."""
+    a, b = break_pt[:-1, None], break_pt[1:, None]
+    x = (a + (b - a)*0.5*(x_i[None, :] + 1)).flatten()
+    return x
+
+
 def kernel_discretization(lamb, error_est=False):
     """
     Return kernel discretization correct to machine prescision for given :math:`\Lambda`
@@ -327,9 +363,7 @@ def kernel_discretization(lamb, error_est=False):
     t_panel_break_pt[1:] = 0.5 ** (npt - i)
 
     t = np.zeros(nt)
-    for i in range(npt):
-        a, b = t_panel_break_pt[i], t_panel_break_pt[i + 1]
-        t[i*order:(i+1)*order] = a + (b - a)*0.5*(x_i+1)
+    t[:npt*order] = _composite_panel_points(t_panel_break_pt, x_i)
 
     # -- Frequency panel discretization
 
@@ -338,13 +372,11 @@ def kernel_discretization(lamb, error_est=False):
     w_panel_break_pt[npo+1:] = lamb * 0.5 ** (npo - j - 1)
     w_panel_break_pt[:npo] = - w_panel_break_pt[npo+1:][::-1]
 
-    w = np.zeros(no)
-    for i in range(2*npo):
-        a, b = w_panel_break_pt[i], w_panel_break_pt[i + 1]
-        w[i*order:(i+1)*order] = a + (b - a)*0.5*(x_i+1)    
+    w = _composite_panel_points(w_panel_break_pt, x_i)
 
-    kmat = kernel(t[:nt//2], w)
-    kmat = np.vstack((kmat, kmat[::-1, ::-1]))
+    kmat = np.empty((nt, no))
+    kernel(t[:nt//2], w, out=kmat[:nt//2])
+    kmat[nt//2:] = kmat[:nt//2][::-1, ::-1]
 
     if not error_est:
         return kmat, t, w
@@ -352,32 +384,38 @@ def kernel_discretization(lamb, error_est=False):
         # -- Error estimate
 
         x2_i = chebyshev_collocation_points_1st_kind(2*N)
+        B_ij = _barycentric_interpolation_matrix(x2_i, x_i, w_i)
+
+        # -- Interpolation error on the tau panels (all frequencies at once)
 
-        err = 0.
-
-        for widx in range(no):
-            for tp in range(npt):
-                a, b = t_panel_break_pt[tp], t_panel_break_pt[tp + 1]
-                X = a + (b - a)*0.5*(x2_i + 1)
-                K = np.squeeze(kernel(X, np.array([w[widx]])))
-                K_interp = barycentric_chebyshev_interpolation(
-                    x2_i, x_i, kmat[N*tp:N*(tp+1), widx], w_i)
-                perr = np.max(np.abs(K - K_interp))
-                err = np.max([err, perr])
-
-        for tidx in range(nt//2):
-            for wp in range(2*npo):
-                a, b = w_panel_break_pt[wp], w_panel_break_pt[wp + 1]
-                X = a + (b - a)*0.5*(x2_i + 1)
-                K = np.squeeze(kernel(np.array([t[tidx]]), X))
-                K_interp = barycentric_chebyshev_interpolation(
-                    x2_i, x_i, kmat[tidx, N*wp:N*(wp+1)], w_i)
-                perr = np.max(np.abs(K - K_interp))
-                err = np.max([err, perr])            
+        X = _composite_panel_points(t_panel_break_pt, x2_i)
+        K_pix = kernel(X, w).reshape((npt, 2*N, no))
+        K_interp_pix = np.matmul(B_ij, kmat[:npt*N].reshape((npt, N, no)))
+        err_t = np.max(np.abs(K_pix - K_interp_pix))
+
+        # -- Interpolation error on the frequency panels (all times at once)
+
+        X = _composite_panel_points(w_panel_break_pt, x2_i)
+        K_tpi = kernel(t[:nt//2], X).reshape((nt//2, 2*npo, 2*N))
+        K_interp_tpi = np.matmul(kmat[:nt//2].reshape((nt//2, 2*npo, N)), B_ij.T)
+        err_w = np.max(np.abs(K_tpi - K_interp_tpi))
+
+        err = np.max([err_t, err_w])
             
         return kmat, t, w, err
 
 
+def _pivoted_qr_columns(A, rank):
+    """Return the indices of the first `rank` pivot columns of the column pivoted QR of `A`.
+
+    Calls Lapack `geqp3` directly and only keeps the pivot vector, the Householder
+    reflectors and the triangular factor are discarded."""
+    geqp3, = get_lapack_funcs(('geqp3',), (A,))
+    qr, jpvt, tau, work, info = geqp3(A)
+    assert(info == 0)
+    return jpvt[:rank] - 1
+
+
 class KernelInterpolativeDecoposition:
 
     """
@@ -405,9 +443,7 @@ class KernelInterpolativeDecoposition:
 
     def __init__(self, lamb, eps=1e-15, xi=-1, max_rank=500, nmax=None, verbose=False):
 
-        if verbose:
-            import time        
-            t_start = time.time()
+        t_start = time.time()
 
         self.xi = xi # +1 for bosons, -1 for fermions
         self.lamb = lamb
@@ -415,25 +451,24 @@ class KernelInterpolativeDecoposition:
 
         if nmax is None: nmax = int(lamb)
 
-        if verbose: t = time.time()
+        t = time.time()
         #self.kmat, self.t, self.om, self.err = kernel_discretization(self.lamb, error_est=True)
         self.kmat, self.t, self.om = kernel_discretization(self.lamb, error_est=False)
-        if verbose: print(f'kernel {time.time() - t} s')
+        _debug(log, verbose, 'kernel %s s', time.time() - t)
 
-        # -- Select real frequency points
+        # -- Select real frequency points (the rank is revealed by the pivoted ID)
 
-        if verbose: t = time.time()
-        self.rank, self.oidx, self.proj_w = \
+        t = time.time()
+        self.rank, self.oidx, _ = \
             interp_decomp(self.kmat, self.eps * self.lamb, rand=False)
         self.oidx = np.sort(self.oidx[:self.rank])
         self.dlrrf = self.om[self.oidx]
-        if verbose: print(f'ID w {time.time() - t} s')
+        _debug(log, verbose, 'ID w %s s', time.time() - t)
 
         # -- Select imaginary time points
 
-        if verbose: t = time.time()
-        self.tidx, self.proj_t = interp_decomp(self.kmat[:, self.oidx].T, self.rank, rand=False)
-        self.tidx = np.sort(self.tidx[:self.rank])
+        t = time.time()
+        self.tidx = np.sort(_pivoted_qr_columns(self.kmat[:, self.oidx].T, self.rank))
 
         #self.dlrit = self.t[self.tidx]
 
@@ -441,38 +476,39 @@ class KernelInterpolativeDecoposition:
         tt += (self.t[::-1] > 0) * (1 - self.t[::-1])
         self.dlrit = tt[self.tidx]
         
-        if verbose: print(f'ID t {time.time() - t} s')
+        _debug(log, verbose, 'ID t %s s', time.time() - t)
             
         # -- Matsubara frequency points
 
-        if verbose: t = time.time()
+        t = time.time()
         n = np.arange(-nmax, nmax+1)
         zeta = 0.5 * (1 - xi) # 0 for bosons, 1 for fermions
         iwn = 1.j * np.pi * (2*n + zeta)
-        self.kmat_mf = 1./(iwn[:, None] + self.dlrrf[None, :])
-        if verbose: print(f'kernel mats {time.time() - t} s')
+        kmat_mf = 1./(iwn[:, None] + self.dlrrf[None, :])
+        _debug(log, verbose, 'kernel mats %s s', time.time() - t)
 
-        if verbose: t = time.time()
-        self.mfidx, self.proj_mf = interp_decomp(self.kmat_mf.T, self.rank, rand=True)
+        t = time.time()
+        self.mfidx, _ = interp_decomp(kmat_mf.T, self.rank, rand=True)
         self.mfidx = np.sort(self.mfidx[:self.rank])
-        if verbose: print(f'ID mats {time.time() - t} s')
+        del kmat_mf
+        _debug(log, verbose, 'ID mats %s s', time.time() - t)
 
         self.nmax = nmax
         self.dlrmf = n[self.mfidx]
 
         # -- Transform matrix DLR-tau (LU-decomposed)
 
-        if verbose: t = time.time()
-        self.T_lx = self.kmat[self.tidx][:, self.oidx]
+        t = time.time()
+        self.T_lx = self.kmat[np.ix_(self.tidx, self.oidx)]
         self.dlrit2cf, self.it2cfpiv = lu_factor(self.T_lx)
-        if verbose: print(f'lu ix {time.time() - t} s')
+        _debug(log, verbose, 'lu ix %s s', time.time() - t)
 
         # -- Transform matrix DLR-Matsubara (LU-decomposed)
 
-        if verbose: t = time.time()
-        self.T_qx = self.kmat_mf[self.mfidx, :]
+        t = time.time()
+        self.T_qx = 1./(iwn[self.mfidx, None] + self.dlrrf[None, :])
         self.dlrmf2cf, self.mf2cfpiv = lu_factor(self.T_qx)
-        if verbose: print(f'lu mats {time.time() - t} s')
+        _debug(log, verbose, 'lu mats %s s', time.time() - t)
 
-        if verbose: print(f'dlr init done {time.time() - t_start} s')
+        _debug(log, verbose, 'dlr init done %s s', time.time() - t_start)
         
@@ -17,215 +17,241 @@ permissions and limitations under the License."""
 
 import os
 import glob
+import logging
 
-libname = glob.glob(os.path.dirname(__file__) + '/../lib/libdlr_c.*')[0]
+from functools import lru_cache
 
-# -- CFFI
+log = logging.getLogger(__name__)
 
-from cffi import FFI
+# -- CFFI, use the compiled API mode extension when built (see _dlr_build.py)
 
-ffi = FFI()
-ffi.cdef("void c_ccfine_init(double *lambda, int *p, int *npt, int *npo, int *nt, int *no);")
-ffi.cdef("void c_ccfine(double *lambda, int *p, int *npt, int *npo, double *t, double *om);")
-ffi.cdef("void c_dlr_kfine(double *lambda, int *p, int *npt, int *npo, double *t, double *om, double *kmat, double *err);")
-ffi.cdef("void c_dlr_rf(double *lambda, double *eps, int *nt, int *no, double *om, double *kmat, int *rank, double *dlrrf, int *oidx);")
-ffi.cdef("void c_dlr_it(double *lambda, int *nt, int *no, double *t, double *kmat, int *rank, int *oidx, double* dlrit, int *tidx);")
-ffi.cdef("void c_dlr_cf2it_init(int *rank, double *dlrrf, double *dlrit, double *cf2it);")
-ffi.cdef("void c_dlr_it2cf_init(int *rank, double *dlrrf, double *dlrit, double *dlrit2cf, int *it2cfpiv);")
-ffi.cdef("void c_dlr_mf(int *nmax, int *rank, double *dlrrf, int *xi, int *dlrmf);")
-ffi.cdef("void c_dlr_cf2mf_init(int *rank, double *dlrrf,int *dlrmf, int *xi, double _Complex *cf2mf);")
-ffi.cdef("void c_dlr_mf2cf_init(int *nmax, int *rank, double *dlrrf,int *dlrmf, int *xi, double _Complex *dlrmf2cf, int *mf2cfpiv);")
-
-lib = ffi.dlopen(libname)
+try:
+    from ._dlr_cffi import ffi, lib
+except ImportError:
+    from ._dlr_build import get_ffi
+    libnames = glob.glob(os.path.dirname(__file__) + '/../lib/libdlr_c.*')
+    if not libnames: raise ImportError('libdlr_c not found, build the Fortran library first.')
+    libname = libnames[0]
+    ffi = get_ffi()
+    lib = ffi.dlopen(libname)
 
 
 import numpy as np
 
+from .kernel import _debug
 
-def get_P(piv):
-    """ Permutation matrix corresponding to Lapack piv index vector """
-    P = np.eye(len(piv))
-    for i, p in enumerate(piv):
-        a = P[:, i].copy()
-        b = P[:, p].copy()
-        P[:, i], P[:, p] = b, a
-    return P
 
+def _ptr(ctype, dtype, a):
+    """ Zero-copy cffi pointer to the memory of the contiguous numpy array `a`
 
-def get_idx(piv):
-    """ Numpy index vector corresponding to Lapack piv index vector """
-    P = get_P(piv)
-    idx = np.zeros_like(piv)
-    for i in range(len(piv)):
-        idx[i] = np.argwhere(P==1)
+    The pointer does not own the memory, `a` has to be kept alive (bound to a name)
+    for as long as the pointer is used. """
+    assert(a.dtype == dtype)
+    assert(a.flags.c_contiguous or a.flags.f_contiguous)
+    return ffi.cast(ctype, a.ctypes.data)
 
-    return idx
 
+def _dptr(a): return _ptr('double *', np.float64, a)
+def _iptr(a): return _ptr('int *', np.int32, a)
+def _zptr(a): return _ptr('double _Complex *', np.complex128, a)
 
-def get_A(lu, piv):
-    L, U = np.tril(lu, k=-1) + np.eye(lu.shape[0]), np.triu(lu)
-    P = get_P(piv)
-    A = P @ L @ U
-    return A
 
+@lru_cache(maxsize=4)
+def _kfine(lamb):
+    """ Composite Chebyshev grids `t`, `om` and kernel matrix `kmat` for the scale `lamb`
 
-class KernelInterpolativeDecopositionFortran:
+    The grid parameters are determined by the libdlr heuristics. The result is memoized
+    for the last few values of `lamb`, the returned arrays are shared between calls and
+    therefore read-only. The memory is released with `clear_kernel_cache()`.
 
-    def __init__(self, lamb, eps=1e-15, xi=-1,
-                 max_rank=500, nmax=None, verbose=False):
+    Returns
+    -------
 
-        print('--> Fortran driver')
-        
-        self.xi = xi
-        self.lamb = lamb
-        self.eps = eps
+    p, npt, npo, nt, no : int
+        Grid parameters.
+    t, om : (nt,), (no,) ndarray
+        Imaginary time (relative format) and real frequency grids.
+    kmat : (nt, no) ndarray
+        Kernel matrix in Fortran order.
+    err : (2,) ndarray
+        Kernel discretization error estimates.
+    """
 
-        if verbose:
-            print(f'xi = {self.xi}')
-            print(f'lambda = {self.lamb}')
-            print(f'eps = {self.eps}')
+    scalars = ffi.new('struct dlr_scalars *')
+    ptr = lambda field: ffi.addressof(scalars, field)
 
-        if nmax is None: nmax = int(lamb)
-        
-        # -- Determine kernel discretization from heuristics
+    scalars.lamb = lamb
+    lamb, p, npt, npo, nt, no = [ ptr(f) for f in ('lamb', 'p', 'npt', 'npo', 'nt', 'no') ]
 
-        lamb = ffi.new('double *', lamb)
-        res = [ ffi.new('int [1]') for n in range(5) ]
+    lib.c_ccfine_init(lamb, p, npt, npo, nt, no)
 
-        lib.c_ccfine_init(lamb, *res)
+    t = np.empty(nt[0], dtype=np.float64)
+    om = np.empty(no[0], dtype=np.float64)
 
-        p, npt, npo, nt, no = [ x for x in res ]
-        self.p, self.npt, self.npo, self.nt, self.no = [ x[0] for x in res ]
-        
-        if verbose:
-            print(f'p = {self.p}')
-            print(f'npt = {self.npt}')
-            print(f'npo = {self.npo}')
-            print(f'nt = {self.nt}')
-            print(f'no = {self.no}')
+    lib.c_ccfine(lamb, p, npt, npo, _dptr(t), _dptr(om))
+
+    kmat = np.empty((nt[0], no[0]), dtype=np.float64, order='F')
+    err = np.empty(2, dtype=np.float64)
+
+    lib.c_dlr_kfine(lamb, p, npt, npo, _dptr(t), _dptr(om), _dptr(kmat), _dptr(err))
 
-        # -- Build analytical continuation kernel
-        t = ffi.new(f'double [{self.nt}]')
-        om = ffi.new(f'double [{self.no}]')
+    for a in (t, om, kmat, err): a.flags.writeable = False
 
-        lib.c_ccfine(lamb, p, npt, npo, t, om)
+    return scalars.p, scalars.npt, scalars.npo, scalars.nt, scalars.no, t, om, kmat, err
 
-        self.t = np.frombuffer(ffi.buffer(t), dtype=np.float)
-        self.om = np.frombuffer(ffi.buffer(om), dtype=np.float)
 
-        if verbose:
-            print(f't.shape = {self.t.shape}')
-            print(f'om.shape = {self.om.shape}')        
+def clear_kernel_cache():
+    """ Release the memoized kernel discretizations of the Fortran driver """
+    _kfine.cache_clear()
 
-        kmat = ffi.new(f'double [{self.nt*self.no}]')
-        err = ffi.new('double [2]')
 
-        lib.c_dlr_kfine(lamb, p, npt, npo, t, om, kmat, err)
+class KernelInterpolativeDecopositionFortran:
+    """ DLR construction using the Fortran library libdlr through its C interface
+
+    The kernel discretization (`t`, `om`, `kmat`) is memoized per :math:`\\Lambda`,
+    the read-only arrays are shared between instances. The cached kernel
+    matrices are released with `clear_kernel_cache()`. """
 
-        self.kmat = np.frombuffer(ffi.buffer(kmat), dtype=np.float).reshape((self.no, self.nt)).T
-        self.err = np.frombuffer(ffi.buffer(err), dtype=np.float)
+    __slots__ = (
+        'xi', 'lamb', 'eps', 'p', 'npt', 'npo', 'nt', 'no', 't', 'om', 'kmat', 'err',
+        'rank', 'oidx', 'dlrrf', 'tidx', 'dlrit', 'it2cfpiv', 'dlrit2cf',
+        'nmax', 'dlrmf', 'mf2cfpiv', 'dlrmf2cf', 'T_lx', 'T_qx',
+        )
+
+    def __init__(self, lamb, eps=1e-15, xi=-1,
+                 max_rank=500, nmax=None, verbose=False):
+
+        self.xi = xi
+        self.lamb = lamb
+        self.eps = eps
+
+        _debug(log, verbose, '--> Fortran driver')
+        _debug(log, verbose, 'xi = %s', self.xi)
+        _debug(log, verbose, 'lambda = %s', self.lamb)
+        _debug(log, verbose, 'eps = %s', self.eps)
+
+        if nmax is None: nmax = int(lamb)
         
-        if verbose:
-            print(f'kmat.shape = {self.kmat.shape}')
-            print(f'err.shape = {self.err.shape}')
-            print(f'err = {self.err}')
+        # -- Kernel discretization (memoized in lamb)
+
+        self.p, self.npt, self.npo, self.nt, self.no, \
+            self.t, self.om, self.kmat, self.err = _kfine(lamb)
+        
+        _debug(log, verbose, 'p = %s', self.p)
+        _debug(log, verbose, 'npt = %s', self.npt)
+        _debug(log, verbose, 'npo = %s', self.npo)
+        _debug(log, verbose, 'nt = %s', self.nt)
+        _debug(log, verbose, 'no = %s', self.no)
+        _debug(log, verbose, 't.shape = %s', self.t.shape)
+        _debug(log, verbose, 'om.shape = %s', self.om.shape)
+        _debug(log, verbose, 'kmat.shape = %s', self.kmat.shape)
+        _debug(log, verbose, 'err.shape = %s', self.err.shape)
+        _debug(log, verbose, 'err = %s', self.err)
+
+        scalars = ffi.new('struct dlr_scalars *')
+        ptr = lambda field: ffi.addressof(scalars, field)
+
+        scalars.lamb, scalars.nt, scalars.no = lamb, self.nt, self.no
+        lamb, nt, no = ptr('lamb'), ptr('nt'), ptr('no')
+        t, om, kmat = _dptr(self.t), _dptr(self.om), _dptr(self.kmat)
 
         # -- Select real frequency points
 
-        eps = ffi.new('double *', eps)
-        rank = ffi.new('int *', max_rank)
-        oidx = ffi.new(f'int [{rank[0]}]')
-        dlrrf = ffi.new(f'double [{rank[0]}]')
+        scalars.eps, scalars.rank = eps, max_rank
+        eps, rank = ptr('eps'), ptr('rank')
+        oidx_np = np.empty(max_rank, dtype=np.int32)
+        dlrrf_np = np.empty(max_rank, dtype=np.float64)
+        oidx, dlrrf = _iptr(oidx_np), _dptr(dlrrf_np)
 
         lib.c_dlr_rf(lamb, eps, nt, no, om, kmat, rank, dlrrf, oidx)
 
         self.rank = rank[0]
-        self.oidx = np.frombuffer(ffi.buffer(oidx), dtype=np.int32)[:self.rank] - 1
-        self.dlrrf = np.frombuffer(ffi.buffer(dlrrf), dtype=np.float)[:self.rank]
 
-        if verbose:
-            print(f'rank = {self.rank}')
-            print(f'oidx = {self.oidx}')
-            print(f'dlrrf = {self.dlrrf}')
+        _debug(log, verbose, 'rank = %s', self.rank)
 
         # -- Select imaginary time points
 
-        tidx = ffi.new(f'int [{self.rank}]')
-        dlrit = ffi.new(f'double [{self.rank}]')
+        # -- NB! dlr_it does not write tidx, zero it as ffi.new did
+        tidx_np = np.zeros(self.rank, dtype=np.int32)
+        dlrit_np = np.empty(self.rank, dtype=np.float64)
+        tidx, dlrit = _iptr(tidx_np), _dptr(dlrit_np)
 
         lib.c_dlr_it(lamb, nt, no, t, kmat, rank, oidx, dlrit, tidx)
 
-        self.tidx = np.frombuffer(ffi.buffer(tidx), dtype=np.int32) - 1
-        self.dlrit = np.frombuffer(ffi.buffer(dlrit), dtype=np.float)
-        self.dlrit = (self.dlrit > 0) * self.dlrit + (self.dlrit < 0) * (1 + self.dlrit)
-
-        if verbose:
-            print(f'tidx = {self.tidx}')
-            print(f'dlrit = {self.dlrit}')
-        
-        # -- Transform matrix (LU-decomposed)
+        # -- Fortran/Lapack indices are 1-based, shift the returned index buffers to 0-based in place
+        tidx_np -= 1
+        self.tidx = tidx_np
 
-        it2cfpiv = ffi.new(f'int [{self.rank}]')
-        dlrit2cf = ffi.new(f'double [{self.rank**2}]')
+        # -- The Fortran routines below take dlrit in relative format, keep dlrit_np as is
+        self.dlrit = (dlrit_np > 0) * dlrit_np + (dlrit_np < 0) * (1 + dlrit_np)
 
-        lib.c_dlr_it2cf_init(rank,dlrrf,dlrit,dlrit2cf,it2cfpiv)
-
-        self.it2cfpiv = np.frombuffer(ffi.buffer(it2cfpiv), dtype=np.int32) - 1
-        self.dlrit2cf = np.frombuffer(
-            ffi.buffer(dlrit2cf), dtype=np.float).reshape((self.rank, self.rank)).T
+        _debug(log, verbose, 'tidx = %s', self.tidx)
+        _debug(log, verbose, 'dlrit = %s', self.dlrit)
         
-        if verbose:
-            print(f'it2cfpiv = {self.it2cfpiv}')
-            #print(f'dlrit2cf = \n{self.dlrit2cf}')
-
-        cf2it = ffi.new(f'double [{self.rank**2}]')
-
-        lib.c_dlr_cf2it_init(rank,dlrrf,dlrit,cf2it)
-
-        self.cf2it = np.frombuffer(
-            ffi.buffer(cf2it), dtype=np.float).reshape((self.rank, self.rank)).T
-            
         # -- Matsubara frequency points
 
         if nmax < self.rank: nmax = self.rank
         
-        if verbose:
-            print(f'nmax = {nmax}')
+        _debug(log, verbose, 'nmax = %s', nmax)
         
-        nmax = ffi.new('int *', nmax)
-        xi = ffi.new('int *', int(xi))
-        dlrmf = ffi.new(f'int [{self.rank}]')
+        scalars.nmax, scalars.xi = nmax, int(xi)
+        nmax, xi = ptr('nmax'), ptr('xi')
+        self.dlrmf = np.empty(self.rank, dtype=np.int32)
+        dlrmf = _iptr(self.dlrmf)
 
         lib.c_dlr_mf(nmax,rank,dlrrf,xi,dlrmf)
 
         self.nmax = nmax[0]
-        self.dlrmf = np.frombuffer(ffi.buffer(dlrmf), dtype=np.int32)
             
-        if verbose:
-            print(f'nmax = {self.nmax}')
-            print(f'dlrmf = {self.dlrmf}')
+        _debug(log, verbose, 'nmax = %s', self.nmax)
+        _debug(log, verbose, 'dlrmf = %s', self.dlrmf)
 
-        mf2cfpiv = ffi.new(f'int [{self.rank}]')
-        dlrmf2cf = ffi.new(f'double _Complex [{self.rank**2}]')
+        # -- Sort the real frequencies (as assumed by dlr) after the point selections above,
+        # -- the buffers are permuted in place so that all matrices below use the sorted order
 
-        lib.c_dlr_mf2cf_init(nmax,rank,dlrrf,dlrmf,xi,dlrmf2cf,mf2cfpiv)
+        r = self.rank
+        perm = np.argsort(dlrrf_np[:r], kind='stable')
+        dlrrf_np[:r], oidx_np[:r] = dlrrf_np[:r][perm], oidx_np[:r][perm]
 
-        self.mf2cfpiv = np.frombuffer(ffi.buffer(mf2cfpiv), dtype=np.int32) - 1
-        self.dlrmf2cf = np.frombuffer(ffi.buffer(dlrmf2cf), dtype=np.complex).reshape((self.rank, self.rank)).T
-            
-        if verbose:
-            print(f'mf2cfpiv = {self.mf2cfpiv}')
-            #print(f'dlrmf2cf = \n{self.dlrmf2cf}')
+        # -- Copy out the first rank entries, the max_rank sized buffers are not kept alive
+        self.oidx = oidx_np[:r] - 1
+        self.dlrrf = dlrrf_np[:r].copy()
 
-        cf2mf = ffi.new(f'double _Complex [{self.rank**2}]')
+        _debug(log, verbose, 'oidx = %s', self.oidx)
+        _debug(log, verbose, 'dlrrf = %s', self.dlrrf)
 
-        lib.c_dlr_cf2mf_init(rank,dlrrf,dlrmf,xi,cf2mf)
+        # -- Transform matrix (LU-decomposed)
 
-        self.cf2mf = np.frombuffer(ffi.buffer(cf2mf), dtype=np.complex).reshape((self.rank, self.rank)).T
-            
-        #self.T_lx = get_A(self.dlrit2cf, self.it2cfpiv)
-        #self.T_qx = get_A(self.dlrmf2cf, self.mf2cfpiv)
+        it2cfpiv_np = np.empty(self.rank, dtype=np.int32)
+        self.dlrit2cf = np.empty((self.rank, self.rank), dtype=np.float64, order='F')
+        it2cfpiv, dlrit2cf = _iptr(it2cfpiv_np), _dptr(self.dlrit2cf)
+
+        lib.c_dlr_it2cf_init(rank,dlrrf,dlrit,dlrit2cf,it2cfpiv)
 
-        self.T_lx = self.cf2it
-        self.T_qx = self.cf2mf
+        it2cfpiv_np -= 1
+        self.it2cfpiv = it2cfpiv_np
         
+        _debug(log, verbose, 'it2cfpiv = %s', self.it2cfpiv)
+        #_debug(log, verbose, 'dlrit2cf = \n%s', self.dlrit2cf)
+
+        self.T_lx = np.empty((self.rank, self.rank), dtype=np.float64, order='F')
+        T_lx = _dptr(self.T_lx)
+
+        lib.c_dlr_cf2it_init(rank,dlrrf,dlrit,T_lx)
+
+        mf2cfpiv_np = np.empty(self.rank, dtype=np.int32)
+        self.dlrmf2cf = np.empty((self.rank, self.rank), dtype=np.complex128, order='F')
+        mf2cfpiv, dlrmf2cf = _iptr(mf2cfpiv_np), _zptr(self.dlrmf2cf)
+
+        lib.c_dlr_mf2cf_init(nmax,rank,dlrrf,dlrmf,xi,dlrmf2cf,mf2cfpiv)
+
+        mf2cfpiv_np -= 1
+        self.mf2cfpiv = mf2cfpiv_np
+            
+        _debug(log, verbose, 'mf2cfpiv = %s', self.mf2cfpiv)
+        #_debug(log, verbose, 'dlrmf2cf = \n%s', self.dlrmf2cf)
+
+        self.T_qx = np.empty((self.rank, self.rank), dtype=np.complex128, order='F')
+        T_qx = _zptr(self.T_qx)
+
+        lib.c_dlr_cf2mf_init(rank,dlrrf,dlrmf,xi,T_qx)
@@ -16,16 +16,79 @@ or implied. See the License for the specific language governing
 permissions and limitations under the License."""
 
  
+import os
+import hashlib
+import tempfile
+import warnings
+import zipfile
+import zlib
+
+from functools import lru_cache
+
 import numpy as np
 import numpy.polynomial.legendre as leg
 
 from scipy.linalg import eigh as scipy_eigh 
-from scipy.linalg import lu_solve, lu_factor
+from scipy.linalg import get_lapack_funcs
+from scipy.linalg import solve as scipy_solve
 
 
 from .kernel import kernel, KernelInterpolativeDecoposition
 
 
+# -- Version of the cached DLR construction, increase when the construction changes
+_CACHE_VERSION = 1
+
+
+@lru_cache(maxsize=None)
+def _getrs(typecode):
+    """Lapack `getrs` routine for the dtype with character code `typecode` (looked up once per dtype)."""
+    getrs, = get_lapack_funcs(('getrs',), dtype=np.dtype(typecode))
+    return getrs
+
+
+def _getrs_solve(lu, piv, b_x):
+    """Solve :math:`A x = b` with the Lapack `getrs` routine and the LU factors of :math:`A`.
+
+    The trailing axes of `b_x` are flattened into right hand sides, complex right hand
+    sides of a real LU factorization are solved as real and imaginary parts."""
+    b_x = np.asarray(b_x)
+    n = b_x.shape[0]
+    b_xA = b_x.reshape((n, -1))
+
+    split = np.iscomplexobj(b_x) and not np.iscomplexobj(lu)
+    if split: b_xA = np.concatenate((b_xA.real, b_xA.imag), axis=1)
+
+    x_xA, info = _getrs(lu.dtype.char)(lu, piv, b_xA)
+    assert(info == 0)
+
+    if split:
+        m = x_xA.shape[1] // 2
+        x_xA = x_xA[:, :m] + 1.j * x_xA[:, m:]
+
+    return x_xA.reshape(b_x.shape)
+
+
+def _matmul_first_axis(T_ix, G_x):
+    """Contract the matrix `T_ix` with the first axis of `G_x` as a single matrix product.
+
+    Equivalent to `np.tensordot(T_ix, G_x, axes=(1, 0))`, but the trailing axes of `G_x`
+    are flattened so that the contraction is one GEMM without intermediate transposes."""
+    G_x = np.asarray(G_x)
+    G_i = np.matmul(T_ix, G_x.reshape((G_x.shape[0], -1)))
+    return G_i.reshape((T_ix.shape[0],) + G_x.shape[1:])
+
+
+def _complex_matmul_first_axis(T_re_ix, T_im_ix, G_x):
+    """Contract the complex matrix `T_re_ix + 1j * T_im_ix` with the first axis of `G_x`.
+
+    Real `G_x` is contracted with the real and imaginary parts as two real GEMMs,
+    instead of one complex GEMM with zero imaginary input."""
+    G_x = np.asarray(G_x)
+    if np.iscomplexobj(G_x): return _matmul_first_axis(T_re_ix + 1.j * T_im_ix, G_x)
+    return _matmul_first_axis(T_re_ix, G_x) + 1.j * _matmul_first_axis(T_im_ix, G_x)
+
+
 class dlr(object):
     
     """
@@ -50,42 +113,75 @@ class dlr(object):
         Default `False`.
     python_impl : bool, optional
         Switch between the python and fortran library driver. Default `True`.
+        Falls back to the python driver when the fortran library is not available.
+        The fortran driver memoizes the kernel discretization per `lamb`, the arrays
+        `t`, `om` and `kmat` are then read-only and shared between instances, release
+        them with `pydlr.kernel_fortran.clear_kernel_cache()`.
+    cache_dir : str, optional
+        Directory for caching the DLR construction on disk, e.g. `~/.cache/pydlr`.
+        Constructions with the same parameters are then loaded from file. Default `None` (no caching).
 
     """
     
     def __init__(self, lamb, eps=1e-15, xi=-1,
-                 max_rank=500, nmax=None, verbose=False, python_impl=True):        
+                 max_rank=500, nmax=None, verbose=False, python_impl=True, cache_dir=None):        
 
         self.xi = xi
         self.lamb = lamb
         self.eps = eps
 
-        if not python_impl:
-            from .kernel_fortran import KernelInterpolativeDecopositionFortran
-            KID = KernelInterpolativeDecopositionFortran
-        else:
-            KID = KernelInterpolativeDecoposition
-            
-        kid = KID(lamb, eps=eps, xi=xi, max_rank=max_rank, nmax=nmax, verbose=verbose)
-
         members = [
             'rank', 't', 'om', 'kmat', 'dlrit', 'dlrrf', 'dlrmf',
             'dlrit2cf', 'it2cfpiv', 'dlrmf2cf', 'mf2cfpiv', 'T_lx', 'T_qx',
             'oidx', 'tidx', #'mfidx',
             ]
-        
-        for member in members: setattr(self, member, getattr(kid, member))
-        
-        del kid
 
-        # -- Sort and split real-frequency nodes
+        if not python_impl:
+            try:
+                from .kernel_fortran import KernelInterpolativeDecopositionFortran
+            except ImportError as e:
+                warnings.warn(f'Fortran driver not available ({e}), falling back to the python driver.')
+                python_impl = True
+
+        KID = KernelInterpolativeDecoposition if python_impl else KernelInterpolativeDecopositionFortran
+
+        cache_file = None
+        if cache_dir is not None:
+            cache_dir = os.path.expanduser(cache_dir)
+            key = repr((_CACHE_VERSION, float(lamb), float(eps), int(xi), int(max_rank), nmax, bool(python_impl)))
+            cache_file = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + '.npz')
+
+        loaded = False
+        if cache_file is not None and os.path.isfile(cache_file):
+            try:
+                with open(cache_file, 'rb') as fh, np.load(fh) as data:
+                    for member in members: setattr(self, member, data[member])
+                self.rank = int(self.rank)
+                loaded = True
+            except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile, zlib.error) as e:
+                warnings.warn(f'Unreadable DLR cache file {cache_file} ({e!r}), rebuilding.')
+
+        if not loaded:
+            kid = KID(lamb, eps=eps, xi=xi, max_rank=max_rank, nmax=nmax, verbose=verbose)
+            for member in members: setattr(self, member, getattr(kid, member))
+            del kid
+
+            if cache_file is not None:
+                # -- Write to a temporary file first so that readers never see a partial file
+                os.makedirs(cache_dir, exist_ok=True)
+                fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix='.npz')
+                with os.fdopen(fd, 'wb') as fh:
+                    np.savez_compressed(fh, **{member : getattr(self, member) for member in members})
+                os.replace(tmp_file, cache_file)
+
+        self.T_lx = np.ascontiguousarray(self.T_lx)
+
+        # -- Sort real-frequency nodes and cache the tau independent kernel factors
 
         self.dlrrf[:] = np.sort(self.dlrrf)
-        self.pm_idx = np.argwhere(self.dlrrf > 0)[0,0]
-        self.dlrrf_p = self.dlrrf[self.pm_idx:]
-        self.dlrrf_m = self.dlrrf[:self.pm_idx]
-        self.kernel_nominator_p = 1 / (1 + np.exp(-self.dlrrf_p))
-        self.kernel_nominator_m = 1 / (1 + np.exp(+self.dlrrf_m))
+        self.dlrrf_pos = self.dlrrf > 0
+        self.dlrrf_abs = np.abs(self.dlrrf)
+        self.kernel_nominator_x = 1 / (1 + np.exp(-self.dlrrf_abs))
 
         # -- Auxilliary variables
 
@@ -103,6 +199,27 @@ class dlr(object):
 
         self.W_bc_xx = self.W_xx * self.bosonic_corr_x[:, None]
         self.TtT_bc_xx = self.TtT_xx * self.bosonic_corr_x[None, :]
+
+        # -- Convolution operators in the layout used by the matrix products
+
+        self.WT_xx = np.ascontiguousarray(self.W_xx.T)
+        self.WT_bc_xx = np.ascontiguousarray(self.W_bc_xx.T)
+        self.TtTk_xx = self.TtT_xx + np.diag(self.k1_x)
+        self.TtTk_bc_xx = self.TtT_bc_xx - np.diag(self.k1_x)
+
+
+    @property
+    def T_qx(self):
+        """Transform matrix from DLR coefficients to Matsubara frequencies.
+
+        Only the real and imaginary parts `T_qx_re` and `T_qx_im` are stored,
+        the complex matrix is assembled on access."""
+        return self.T_qx_re + 1.j * self.T_qx_im
+
+    @T_qx.setter
+    def T_qx(self, T_qx):
+        self.T_qx_re = np.ascontiguousarray(T_qx.real)
+        self.T_qx_im = np.ascontiguousarray(T_qx.imag)
         
         
     def __len__(self):
@@ -183,7 +300,7 @@ class dlr(object):
             Green's function i DLR coefficient space with :math:`m \\times m` orbital indices.
         """
 
-        G_xaa = lu_solve((self.dlrit2cf, self.it2cfpiv), G_laa)
+        G_xaa = _getrs_solve(self.dlrit2cf, self.it2cfpiv, G_laa)
         return G_xaa
 
 
@@ -204,7 +321,7 @@ class dlr(object):
             Green's function in imaginary time with :math:`m \\times m` orbital indices.
         """
 
-        G_laa = np.tensordot(self.T_lx, G_xaa, axes=(1, 0))
+        G_laa = _matmul_first_axis(self.T_lx, G_xaa)
         return G_laa
 
 
@@ -254,14 +371,10 @@ class dlr(object):
         """
 
         tau_k = tau_k[:, None] / beta
-        
-        w_p = self.dlrrf_p[None, :]
-        K_kp = np.exp(-tau_k*w_p) * self.kernel_nominator_p[None, :]
-        G_kaa = np.einsum('kp,p...->k...', K_kp, G_xaa[self.pm_idx:])
 
-        w_m = self.dlrrf_m[None, :]
-        K_km = np.exp((1 - tau_k)*w_m) * self.kernel_nominator_m[None, :]
-        G_kaa += np.einsum('km,m...->k...', K_km, G_xaa[:self.pm_idx])
+        s_kx = np.where(self.dlrrf_pos[None, :], tau_k, 1 - tau_k)
+        K_kx = np.exp(-s_kx * self.dlrrf_abs[None, :]) * self.kernel_nominator_x[None, :]
+        G_kaa = _matmul_first_axis(K_kx, G_xaa)
 
         return G_kaa
 
@@ -351,7 +464,7 @@ class dlr(object):
         """
         xi = self.__xi_arg(xi)
 
-        G_xaa = lu_solve((self.dlrmf2cf, self.mf2cfpiv), G_qaa.conj() / beta)
+        G_xaa = _getrs_solve(self.dlrmf2cf, self.mf2cfpiv, G_qaa.conj() / beta)
 
         if xi == 1: G_xaa /= self.bosonic_corr_x[:, None, None]
 
@@ -383,10 +496,10 @@ class dlr(object):
         xi = self.__xi_arg(xi)
 
         if xi == 1:
-            G_qaa = beta * np.tensordot(
-                self.T_qx * self.bosonic_corr_x[None, :], G_xaa, axes=(1, 0))
-        else:
-            G_qaa = beta * np.tensordot(self.T_qx, G_xaa, axes=(1, 0))
+            G_xaa = np.asarray(G_xaa)
+            G_xaa = self.bosonic_corr_x.reshape((-1,) + (1,)*(G_xaa.ndim - 1)) * G_xaa
+
+        G_qaa = beta * _complex_matmul_first_axis(self.T_qx_re, self.T_qx_im, G_xaa)
 
         if len(G_qaa.shape) == 3: G_qaa = np.transpose(G_qaa, axes=(0, 2, 1))
         G_qaa = G_qaa.conj()
@@ -424,7 +537,7 @@ class dlr(object):
         w_x = self.dlrrf / beta
         kernel_zx = 1./(z[:, None] + w_x[None, :])
         if xi == 1: kernel_zx *= self.bosonic_corr_x[None, :]
-        G_zaa = np.einsum('x...,zx->z...', G_xaa, kernel_zx)
+        G_zaa = _matmul_first_axis(kernel_zx, G_xaa)
         if len(G_zaa.shape) == 3: G_zaa = np.transpose(G_zaa, axes=(0, 2, 1))
         G_zaa = G_zaa.conj()
         
@@ -469,24 +582,32 @@ class dlr(object):
         """
         xi = self.__xi_arg(xi)
         
-        W_xx = self.W_xx if xi == -1 else self.W_bc_xx
-        TtT_xx = self.TtT_xx if xi == -1 else self.TtT_bc_xx
+        WT_xx = self.WT_xx if xi == -1 else self.WT_bc_xx
+        TtTk_xx = self.TtTk_xx if xi == -1 else self.TtTk_bc_xx
 
         n, na, _ = A_xaa.shape
 
-        WA_xaa = np.matmul(W_xx.T, A_xaa.reshape((n, na*na))).reshape((n, na, na))
+        if na == 1:
+            # -- Scalar Green's functions, skip the stacked (1, 1) matrix products
+            a_x, b_x = A_xaa[:, 0, 0], B_xaa[:, 0, 0]
+            c_x = (WT_xx @ a_x) * b_x + a_x * (WT_xx @ b_x) + TtTk_xx @ (a_x * b_x)
+            C_xaa = (beta * c_x).reshape((n, 1, 1))
+            return C_xaa
+
+        A_xA, B_xA = A_xaa.reshape((n, na*na)), B_xaa.reshape((n, na*na))
+
+        WA_xaa = np.matmul(WT_xx, A_xA).reshape((n, na, na))
         C_xaa = np.matmul(WA_xaa, B_xaa)
         del WA_xaa
 
-        WB_xaa = np.matmul(W_xx.T, B_xaa.reshape((n, na*na))).reshape((n, na, na))
+        WB_xaa = np.matmul(WT_xx, B_xA).reshape((n, na, na))
         C_xaa += np.matmul(A_xaa, WB_xaa)
         del WB_xaa
-            
-        AB_xaa = np.matmul(A_xaa, B_xaa)
-        C_xaa += -xi * self.k1_x[:, None, None] * AB_xaa
 
-        C_xaa += np.matmul(TtT_xx, AB_xaa.reshape((n, na*na))).reshape((n, na, na))
-        del AB_xaa
+        # -- The diagonal -xi * k1_x term is fused into TtTk_xx
+        AB_xA = np.matmul(A_xaa, B_xaa).reshape((n, na*na))
+        C_xaa += np.matmul(TtTk_xx, AB_xA).reshape((n, na, na))
+        del AB_xA
         
         C_xaa *= beta
         
@@ -525,20 +646,22 @@ class dlr(object):
         """
         xi = self.__xi_arg(xi)
         
-        W_xx = self.W_xx if xi == -1 else self.W_bc_xx
+        WT_xx = self.WT_xx if xi == -1 else self.WT_bc_xx
         TtT_xx = self.TtT_xx if xi == -1 else self.TtT_bc_xx
 
         n, na, _ = A_xaa.shape
 
-        Q_xaa = np.einsum('yx,yab->xab', W_xx, A_xaa)
+        Q_xaa = np.matmul(WT_xx, A_xaa.reshape((n, na*na))).reshape((n, na, na))
         Q_xaa += -xi * self.k1_x[:,None,None] * A_xaa
 
-        M_xxaa = np.einsum( 'xy,yab->yxab', W_xx,   A_xaa)
-        M_xxaa += np.einsum('xy,yab->xyab', TtT_xx, A_xaa)
-        M_xxaa += np.einsum('xy,yab->xyab', np.eye(n),   Q_xaa)
-        M_xxaa *= beta
-        
-        M_xaxa = np.moveaxis(M_xxaa, 2, 1)
+        # -- Built directly in the (x, a, y, b) layout of the result
+
+        M_xaxa = WT_xx[:, None, :, None] * A_xaa[:, :, None, :]
+        M_xaxa += TtT_xx[:, None, :, None] * A_xaa.transpose((1, 0, 2))[None, :, :, :]
+
+        diag = np.arange(n)
+        M_xaxa[diag, :, diag, :] += Q_xaa
+        M_xaxa *= beta
         
         return M_xaxa
 
@@ -652,7 +775,9 @@ class dlr(object):
         
         if xi == 1: g_lE /= self.__bosonic_corr_freq(E*beta)[None, :]
         
-        g_laa = np.einsum('lE,aE,Eb->lab', g_lE, U, U.T.conj())
+        n, na = g_lE.shape
+        gU_laE = U[None, :, :] * g_lE[:, None, :]
+        g_laa = np.matmul(gU_laE.reshape((n*na, na)), U.T.conj()).reshape((n, na, na))
 
         return g_laa    
 
@@ -862,10 +987,14 @@ class dlr(object):
             #D_AA = np.kron(self.T_lx, I_aa) - self.tau_from_dlr(self.convolution_matrix(g0Sigma_xaa, beta)).reshape((n*na, n*na))        
             #b_Aa = g0_iaa.reshape((n*na, na))
 
-            D_AA = np.kron(np.eye(n), I_aa) - self.convolution_matrix(g0Sigma_xaa, beta).reshape((n*na, n*na))
+            # -- Form (1 - [g0Sigma *]) in place and let Lapack overwrite it
+
+            D_AA = self.convolution_matrix(g0Sigma_xaa, beta).reshape((n*na, n*na))
+            D_AA *= -1
+            D_AA[np.diag_indices(n*na)] += 1.
             b_Aa = g0_xaa.reshape((n*na, na))
 
-            g_xaa = np.linalg.solve(D_AA, b_Aa).reshape((n, na, na))
+            g_xaa = scipy_solve(D_AA, b_Aa, overwrite_a=True).reshape((n, na, na))
 
         return g_xaa
     
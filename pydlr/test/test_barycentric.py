@@ -78,7 +78,29 @@ def test_barycentric_interp_on_grid(verbose=False):
         print(f'diff = {np.max(np.abs(f_j - f_j_interp))}')
     
     np.testing.assert_array_almost_equal(f_j, f_j_interp)
-            
+
+
+def test_barycentric_interp_trailing_dims():
+    """Interpolation of several functions at once using
+    trailing dimensions of the function values."""
+
+    N = 32
+    x_i = chebyshev_collocation_points_1st_kind(N)
+    w_i = chebyshev_barycentric_weights_1st_kind(N)
+
+    k = 0.5 * np.arange(1, 7).reshape((2, 3))
+    f = lambda x : np.sin(np.pi * x[:, None, None] * k[None, ...])
+
+    f_i = f(x_i)
+
+    x_j = np.concatenate((np.linspace(-1, 1, num=100), x_i[::4]))
+    f_j = f(x_j)
+
+    f_j_interp = barycentric_chebyshev_interpolation(x_j, x_i, f_i, w_i)
+
+    assert(f_j_interp.shape == f_j.shape)
+    np.testing.assert_array_almost_equal(f_j, f_j_interp)
+
 
 if __name__ == '__main__':
 
@@ -0,0 +1,101 @@
+"""Test on-disk caching of the DLR construction.
+
+Copyright 2021 Hugo U.R. Strand
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License."""
+
+
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+from pydlr import dlr
+from pydlr import pydlr
+
+
+def test_cache(verbose=False):
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+
+        d_ref = dlr(lamb=40., eps=1e-12)
+        d_write = dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+
+        files = os.listdir(cache_dir)
+        if verbose: print(f'cache files = {files}')
+        assert(len(files) == 1)
+
+        d_read = dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+        assert(os.listdir(cache_dir) == files)
+
+        for d in [d_write, d_read]:
+            assert(d.rank == d_ref.rank)
+            np.testing.assert_array_equal(d.dlrrf, d_ref.dlrrf)
+            np.testing.assert_array_equal(d.dlrit, d_ref.dlrit)
+            np.testing.assert_array_equal(d.dlrmf, d_ref.dlrmf)
+            np.testing.assert_array_equal(d.T_lx, d_ref.T_lx)
+            np.testing.assert_array_equal(d.TtT_xx, d_ref.TtT_xx)
+
+        dlr(lamb=40., eps=1e-10, cache_dir=cache_dir)
+        assert(len(os.listdir(cache_dir)) == 2)
+
+
+def test_cache_corrupt(verbose=False):
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+
+        d_ref = dlr(lamb=40., eps=1e-12)
+        dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+        cache_file, = [ os.path.join(cache_dir, f) for f in os.listdir(cache_dir) ]
+
+        for data in [b'', b'not a npz file', open(cache_file, 'rb').read()[:100]]:
+
+            with open(cache_file, 'wb') as fh: fh.write(data)
+
+            with warnings.catch_warnings(record=True) as w:
+                warnings.simplefilter('always')
+                d = dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+
+            if verbose: print(w[0].message)
+            assert(len(w) == 1)
+            np.testing.assert_array_equal(d.dlrrf, d_ref.dlrrf)
+            np.testing.assert_array_equal(d.T_lx, d_ref.T_lx)
+
+            # -- The rebuilt construction replaces the unreadable file
+            d_read = dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+            np.testing.assert_array_equal(d_read.T_lx, d_ref.T_lx)
+
+
+def test_cache_version(verbose=False):
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+
+        dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+
+        version = pydlr._CACHE_VERSION
+        try:
+            pydlr._CACHE_VERSION = version + 1
+            dlr(lamb=40., eps=1e-12, cache_dir=cache_dir)
+        finally:
+            pydlr._CACHE_VERSION = version
+
+        if verbose: print(f'cache files = {os.listdir(cache_dir)}')
+        assert(len(os.listdir(cache_dir)) == 2)
+
+
+if __name__ == '__main__':
+
+    test_cache(verbose=True)
+    test_cache_corrupt(verbose=True)
+    test_cache_version(verbose=True)
@@ -0,0 +1,41 @@
+"""Test copying of DLR objects.
+
+Copyright 2021 Hugo U.R. Strand
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License."""
+
+
+import copy
+
+import numpy as np
+
+from pydlr import dlr
+
+
+def test_deepcopy(verbose=False):
+
+    beta = 10.
+    d = dlr(lamb=40.)
+    d_copy = copy.deepcopy(d)
+
+    G_laa = np.random.randn(len(d), 2, 2)
+    G_qaa = d.matsubara_from_dlr(d.dlr_from_tau(G_laa), beta)
+
+    np.testing.assert_array_equal(d_copy.dlr_from_tau(G_laa), d.dlr_from_tau(G_laa))
+    np.testing.assert_array_equal(
+        d_copy.dlr_from_matsubara(G_qaa, beta), d.dlr_from_matsubara(G_qaa, beta))
+
+
+if __name__ == '__main__':
+
+    test_deepcopy(verbose=True)
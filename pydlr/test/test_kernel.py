@@ -22,7 +22,10 @@ from pydlr import dlr, kernel
 def test_kernel(verbose=False):
 
     d = dlr(lamb=10., python_impl=True, verbose=True)
-    d.tt = (d.t > 0) * d.t + (d.t[::-1] > 0) * (1 - d.t[::-1])
+    d.tt = np.empty_like(d.t)
+    np.subtract(1., d.t[::-1], out=d.tt)
+    d.tt *= d.t[::-1] > 0
+    d.tt += (d.t > 0) * d.t
     
     kmat = kernel(d.tt, d.om)
 
@@ -69,6 +72,18 @@ def test_kernel(verbose=False):
 
 
 
+def test_kernel_out():
+
+    tau = np.linspace(0, 1, num=11)
+    omega = np.linspace(-20, 20, num=13)
+
+    out = np.empty((len(tau), len(omega)))
+    kmat = kernel(tau, omega, out=out)
+
+    assert(kmat is out)
+    np.testing.assert_array_equal(kmat, kernel(tau, omega))
+
+
 if __name__ == '__main__':
 
     test_kernel(verbose=True)
@@ -0,0 +1,107 @@
+"""Tests of the Fortran library driver of the DLR construction.
+
+Copyright 2021 Hugo U.R. Strand
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License."""
+
+
+import itertools
+import numpy as np
+
+from pydlr import dlr, kernel
+
+try:
+    from pydlr import kernel_fortran
+except ImportError as e:
+    print(f'Fortran driver not available, skipping tests: {e}')
+    kernel_fortran = None
+
+
+def test_transform_matrices(verbose=False):
+
+    if kernel_fortran is None: return
+
+    for lamb, xi in itertools.product([10., 100.], [-1, 1]):
+
+        d = dlr(lamb=lamb, xi=xi, python_impl=False)
+        if verbose: print(f'lamb = {lamb}, xi = {xi}, rank = {d.rank}')
+
+        assert(np.all(np.diff(d.dlrrf) > 0))
+
+        np.testing.assert_allclose(d.T_lx, kernel(d.dlrit, d.dlrrf), atol=1e-13)
+
+        zeta = 0.5 * (1 - xi)
+        iwq = 1.j * np.pi * (2*d.dlrmf + zeta)
+        np.testing.assert_allclose(d.T_qx, 1./(iwq[:, None] + d.dlrrf[None, :]), atol=1e-13)
+
+
+def test_python_driver_agreement(verbose=False):
+
+    if kernel_fortran is None: return
+
+    beta = 10.
+    H_aa = np.array([[0.3, 0.1], [0.1, -0.5]])
+    tau_i = np.linspace(0, beta, num=101)
+
+    for lamb, xi in itertools.product([10., 100.], [-1, 1]):
+
+        d_f = dlr(lamb=lamb, xi=xi, python_impl=False)
+        d_p = dlr(lamb=lamb, xi=xi, python_impl=True)
+
+        if verbose: print(f'lamb = {lamb}, xi = {xi}, rank = {d_f.rank} (fortran), {d_p.rank} (python)')
+
+        assert(abs(d_f.rank - d_p.rank) <= 0.2 * d_p.rank)
+        assert(np.all(d_f.dlrit > 0) and np.all(d_f.dlrit < 1))
+
+        G_iaa = d_p.eval_dlr_tau(d_p.free_greens_function_dlr(H_aa, beta), tau_i, beta)
+
+        # -- Imaginary time round trip
+
+        G_xaa = d_f.dlr_from_tau(d_f.free_greens_function_tau(H_aa, beta))
+        np.testing.assert_allclose(d_f.eval_dlr_tau(G_xaa, tau_i, beta), G_iaa, atol=1e-12)
+
+        # -- Matsubara frequency round trip
+
+        G_qaa = d_f.matsubara_from_dlr(G_xaa, beta)
+        G_xaa_rt = d_f.dlr_from_matsubara(G_qaa, beta)
+        np.testing.assert_allclose(d_f.eval_dlr_tau(G_xaa_rt, tau_i, beta), G_iaa, atol=1e-10)
+
+
+def test_kfine_memoization(verbose=False):
+
+    if kernel_fortran is None: return
+
+    lamb = 20.
+    kernel_fortran.clear_kernel_cache()
+
+    d1 = kernel_fortran.KernelInterpolativeDecopositionFortran(lamb, eps=1e-10)
+    d2 = kernel_fortran.KernelInterpolativeDecopositionFortran(lamb, eps=1e-12)
+
+    info = kernel_fortran._kfine.cache_info()
+    if verbose: print(info)
+    assert(info.misses == 1 and info.hits == 1)
+
+    # -- Instances share the read-only memoized arrays
+    for name in ['t', 'om', 'kmat']:
+        a1, a2 = getattr(d1, name), getattr(d2, name)
+        assert(a1 is a2 and not a1.flags.writeable)
+
+    kernel_fortran.clear_kernel_cache()
+    assert(kernel_fortran._kfine.cache_info().currsize == 0)
+
+
+if __name__ == '__main__':
+
+    test_transform_matrices(verbose=True)
+    test_python_driver_agreement(verbose=True)
+    test_kfine_memoization(verbose=True)
@@ -0,0 +1,48 @@
+"""Test round trip accuracy of the Matsubara frequency transforms.
+
+Copyright 2021 Hugo U.R. Strand
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express
+or implied. See the License for the specific language governing
+permissions and limitations under the License."""
+
+
+import itertools
+import numpy as np
+
+from pydlr import dlr
+
+
+def test_matsubara_roundtrip(verbose=False):
+
+    beta = 10.
+    H_aa = np.array([[0.3, 0.1], [0.1, -0.5]])
+    tau_i = np.linspace(0, beta, num=101)
+
+    for lamb, xi in itertools.product([10., 40., 100., 1000.], [-1, 1]):
+
+        d = dlr(lamb=lamb, xi=xi)
+
+        G_xaa = d.free_greens_function_dlr(H_aa, beta)
+        G_qaa = d.matsubara_from_dlr(G_xaa, beta)
+        G_xaa_rt = d.dlr_from_matsubara(G_qaa, beta)
+
+        G_iaa = d.eval_dlr_tau(G_xaa, tau_i, beta)
+        G_iaa_rt = d.eval_dlr_tau(G_xaa_rt, tau_i, beta)
+
+        diff = np.max(np.abs(G_iaa - G_iaa_rt))
+        if verbose: print(f'lamb = {lamb}, xi = {xi}, rank = {len(d)}, diff = {diff:2.2E}')
+        assert(diff < 1e-10)
+
+
+if __name__ == '__main__':
+
+    test_matsubara_roundtrip(verbose=True)